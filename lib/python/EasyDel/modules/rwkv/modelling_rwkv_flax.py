@@ -2,6 +2,7 @@ import functools
 import math
 from typing import Optional, Tuple, Any, Union, List, Dict, Mapping
 import chex
+import numpy as np
 import flax.linen.partitioning
 import jax.lax
 from transformers.modeling_flax_outputs import FlaxBaseModelOutput, FlaxCausalLMOutput, FlaxMaskedLMOutput, ModelOutput
@@ -10,8 +11,10 @@ from flax.linen import combine_masks
 from flax.traverse_util import unflatten_dict, flatten_dict
 from jax import numpy as jnp, lax
 from flax import linen as nn
+from flax.linen import partitioning as nn_partitioning
 from .rwkv_configuration import RwkvConfig
 from ..easydel_modelling_utils import EasyDelFlaxPretrainedModel
+from ..flax_modelling_utils import get_gradient_checkpoint_policy
 from jax.sharding import PartitionSpec
 from flax.struct import dataclass
 
@@ -33,7 +36,24 @@ class RwkvCausalLMOutput(ModelOutput):
 
 
 def init_to_value(x, dtype):
-    return lambda _: x.astype(dtype)
+    return lambda _: jnp.asarray(x, dtype=dtype)
+
+
+def layer_constants(fn, layer_id, num_hidden_layers):
+    """
+    The layer_constants function evaluates the NumPy function `fn(layer_id)` on the host, so the layer dependent
+    initial values are plain constants instead of traced ops. Under `scan_layers` the layer id is traced, in that
+    case the values of every layer are built once and the traced id selects its row.
+
+    :param fn: Callable: NumPy function of the layer id returning a tuple of arrays
+    :param layer_id: Layer id (int, or traced array under `scan_layers`)
+    :param num_hidden_layers: int: Number of layers
+    :return: The tuple returned by `fn` for `layer_id`
+    """
+    if isinstance(layer_id, int):
+        return fn(layer_id)
+    per_layer = [fn(idx) for idx in range(num_hidden_layers)]
+    return tuple(jnp.asarray(np.stack(values))[layer_id] for values in zip(*per_layer))
 
 
 def init_state(hidden_size):
@@ -44,40 +64,216 @@ def init_state(hidden_size):
     return time_mix_state, channel_mix_state
 
 
-@jax.jit
+def time_shift(hidden, previous):
+    """
+    The time_shift function shifts `hidden` one step along the time axis (the one before the hidden axis) and puts
+    `previous` (the last token seen by the previous call, or zeros) in the first position. The result has exactly
+    the shape and dtype of `hidden`. For a single token the shifted states are just `previous`, so no concatenate is
+    emitted on the decode path.
+
+    :param hidden: chex.Array: Hidden states
+    :param previous: chex.Array: Hidden state of the token before the first one in `hidden`
+    :return: The shifted hidden states
+    """
+    if hidden.shape[-2] == 1:
+        return jnp.expand_dims(previous, -2).astype(hidden.dtype)
+    return jnp.concatenate(
+        (jnp.expand_dims(previous, -2).astype(hidden.dtype), hidden[..., :-1, :]),
+        axis=-2
+    )
+
+
+def time_mix(hidden, previous, mix):
+    """
+    The time_mix function builds the input of the RWKV projections: it time-shifts `hidden` and interpolates between
+    the hidden and shifted states, written as `shifted + (hidden - shifted) * mix` so no separate `1 - mix` term is
+    built and XLA can fuse shift and mix into the producer of the matmul input under the model's jit. `mix` can carry
+    leading axes to produce several mixes at once, e.g. (3, 1, hidden) for the key/value/receptance mixes.
+
+    :param hidden: chex.Array: Hidden states
+    :param previous: chex.Array: Hidden state of the token before the first one in `hidden`
+    :param mix: chex.Array: Time-mix coefficients
+    :return: The mixed hidden states
+    """
+    shifted = time_shift(hidden, previous)
+    return shifted + (hidden - shifted) * mix
+
+
+def max_shift(x, y):
+    """
+    The max_shift function returns `m = max(x, y)` together with `exp(x - m)` and `exp(y - m)`. One of the two
+    exponentials is always 1 and the other one is `exp(-|x - y|)`, so a single `exp` is evaluated instead of two.
+
+    :param x: chex.Array: First exponent
+    :param y: chex.Array: Second exponent
+    :return: A tuple of (max, exp(x - max), exp(y - max))
+    """
+    difference = x - y
+    scale = jnp.exp(-jnp.abs(difference))
+    x_is_max = difference >= 0
+    return jnp.maximum(x, y), jnp.where(x_is_max, 1.0, scale), jnp.where(x_is_max, scale, 1.0)
+
+
+def wkv_step(time_decay, key, key_with_bonus, value, state):
+    """
+    The wkv_step function is one token of the RWKV (WKV) recurrence, shared by the `jax.lax.scan` body of
+    `rwkv_linear_attention` and the single token `rwkv_linear_attention_step`. All inputs are float32.
+
+    :param time_decay: chex.Array: Per-channel log decay (already `-exp(time_decay)`)
+    :param key: chex.Array: Key of the current token
+    :param key_with_bonus: chex.Array: Key of the current token plus `time_first`
+    :param value: chex.Array: Value of the current token
+    :param state: Tuple of (numerator, denominator, max) before the current token
+    :return: A tuple of the output of the current token and the (numerator, denominator, max) state after it
+    """
+    num_state, den_state, max_state = state
+
+    _, e1, e2 = max_shift(max_state, key_with_bonus)
+    output = (e1 * num_state + e2 * value) / (e1 * den_state + e2)
+
+    max_for_state, e1, e2 = max_shift(max_state + time_decay, key)
+    return output, (e1 * num_state + e2 * value, e1 * den_state + e2, max_for_state)
+
+
+@functools.partial(jax.jit, static_argnames=("return_state",))
 def rwkv_linear_attention(time_decay, time_first, key, value, state=None, return_state=False):
-    current_sequence_length = key.shape[1]
-    output = jnp.zeros_like(key)
-
+    """
+    The rwkv_linear_attention function runs the RWKV (WKV) recurrence over the time axis of `key` and `value`.
+    The time axis is the one before the hidden axis, so both `(sequence_length, hidden)` and
+    `(batch, sequence_length, hidden)` inputs are supported. The recurrence is driven by `jax.lax.scan`, so the
+    traced graph does not grow with the sequence length. The recurrence runs in float32 and both the output and the
+    returned (numerator, denominator, max) state stay in float32.
+
+    :param time_decay: chex.Array: Per-channel decay (before the `-exp` transform)
+    :param time_first: chex.Array: Per-channel bonus given to the current token
+    :param key: chex.Array: Key states
+    :param value: chex.Array: Value states
+    :param state: Optional state of (numerator, denominator, max) to continue from
+    :param return_state: bool: Whether to return the final state
+    :return: A tuple of the (float32) output states and the (numerator, denominator, max) state
+    """
     if state is None:
-        num_state = jnp.zeros_like(key[:, 0], dtype=jnp.float32)
-        den_state = jnp.zeros_like(key[:, 0], dtype=jnp.float32)
-        max_state = jnp.zeros_like(key[:, 0], dtype=jnp.float32) - 1e38
+        num_state = jnp.zeros_like(key[..., 0, :], dtype=jnp.float32)
+        den_state = jnp.zeros_like(key[..., 0, :], dtype=jnp.float32)
+        max_state = jnp.zeros_like(key[..., 0, :], dtype=jnp.float32) - 1e38
     else:
-        num_state, den_state, max_state = state
+        num_state, den_state, max_state = (s.astype(jnp.float32) for s in state)
 
+    # loop invariant parts of the recurrence are computed once for the whole sequence
     time_decay = -jnp.exp(time_decay)
+    current_key = key.astype(jnp.float32)
+    key_with_bonus = current_key + time_first
+
+    def step(carry, kv):
+        output, carry = wkv_step(time_decay, *kv, carry)
+        return carry, output
+
+    (num_state, den_state, max_state), output = jax.lax.scan(
+        step,
+        (num_state, den_state, max_state),
+        (
+            jnp.moveaxis(current_key, -2, 0),
+            jnp.moveaxis(key_with_bonus, -2, 0),
+            jnp.moveaxis(value.astype(jnp.float32), -2, 0)
+        )
+    )
+    output = jnp.moveaxis(output, 0, -2)
+
+    if return_state or state is not None:
+        # the numerator (a decayed sum of values) and the denominator (up to ~1 / (1 - exp(-exp(time_decay))))
+        # are not bounded, so the whole state is kept in float32 to avoid drift over long decodes
+        state = [num_state, den_state, max_state]
+
+    return output, state
+
 
-    for current_index in range(current_sequence_length):
-        current_key = key[:, current_index].float()
-        current_value = value[:, current_index]
+@jax.jit
+def rwkv_linear_attention_step(time_decay, time_first, key, value, state):
+    """
+    The rwkv_linear_attention_step function is the single token (decode) form of `rwkv_linear_attention`: the same
+    `wkv_step` as the scan body, applied once with no scan around it. `key` and `value` carry
+    a time axis of length 1 so the output matches the layout of the sequence kernels.
+
+    :param time_decay: chex.Array: Per-channel decay (before the `-exp` transform)
+    :param time_first: chex.Array: Per-channel bonus given to the current token
+    :param key: chex.Array: Key states of shape (..., 1, hidden)
+    :param value: chex.Array: Value states of shape (..., 1, hidden)
+    :param state: State of (numerator, denominator, max) to continue from
+    :return: A tuple of the (float32) output states and the (numerator, denominator, max) state
+    """
+    num_state, den_state, max_state = (s.astype(jnp.float32) for s in state)
+    current_key = key[..., 0, :].astype(jnp.float32)
+
+    output, (num_state, den_state, max_state) = wkv_step(
+        -jnp.exp(time_decay),
+        current_key,
+        current_key + time_first,
+        value[..., 0, :].astype(jnp.float32),
+        (num_state, den_state, max_state)
+    )
+    return output[..., None, :], [num_state, den_state, max_state]
+
+
+@functools.partial(jax.jit, static_argnames=("return_state",))
+def rwkv_linear_attention_parallel(time_decay, time_first, key, value, state=None, return_state=False):
+    """
+    The rwkv_linear_attention_parallel function computes the same recurrence as `rwkv_linear_attention` but with
+    `jax.lax.associative_scan`, so a prompt of length T is processed in ~log2(T) parallel steps instead of T
+    sequential ones. Every token is turned into a (log_decay, numerator, denominator, max) element and elements
+    are merged with the max-shifted (online softmax) combine, which is associative. The incoming state is
+    prepended as the first element, so the exclusive prefix (the state *before* each token) is read from the
+    inclusive scan shifted by one.
+
+    :param time_decay: chex.Array: Per-channel decay (before the `-exp` transform)
+    :param time_first: chex.Array: Per-channel bonus given to the current token
+    :param key: chex.Array: Key states
+    :param value: chex.Array: Value states
+    :param state: Optional state of (numerator, denominator, max) to continue from
+    :param return_state: bool: Whether to return the final state
+    :return: A tuple of the (float32) output states and the (numerator, denominator, max) state
+    """
+    if state is None:
+        num_state = jnp.zeros_like(key[..., 0, :], dtype=jnp.float32)
+        den_state = jnp.zeros_like(key[..., 0, :], dtype=jnp.float32)
+        max_state = jnp.zeros_like(key[..., 0, :], dtype=jnp.float32) - 1e38
+    else:
+        num_state, den_state, max_state = (s.astype(jnp.float32) for s in state)
 
-        max_for_output = jnp.maximum(max_state, current_key + time_first)
-        e1 = jnp.exp(max_state - max_for_output)
-        e2 = jnp.exp(current_key + time_first - max_for_output)
-        numerator = e1 * num_state + e2 * current_value
-        denominator = e1 * den_state + e2
-        output[:, current_index] = (numerator / denominator).astype(output.dtype)
+    time_decay = -jnp.exp(time_decay)
+    sequence_axis = key.ndim - 2
+    current_key = key.astype(jnp.float32)
+    current_value = value.astype(jnp.float32)
+
+    def combine(earlier, later):
+        earlier_decay, earlier_num, earlier_den, earlier_max = earlier
+        later_decay, later_num, later_den, later_max = later
+        max_for_state, e1, e2 = max_shift(earlier_max + later_decay, later_max)
+        return (
+            earlier_decay + later_decay,
+            e1 * earlier_num + e2 * later_num,
+            e1 * earlier_den + e2 * later_den,
+            max_for_state
+        )
 
-        max_for_state = jnp.maximum(max_state + time_decay, current_key)
-        e1 = jnp.exp(max_state + time_decay - max_for_state)
-        e2 = jnp.exp(current_key - max_for_state)
-        num_state = e1 * num_state + e2 * current_value
-        den_state = e1 * den_state + e2
-        max_state = max_for_state
+    elements = (
+        jnp.concatenate(
+            (jnp.zeros_like(num_state)[..., None, :], jnp.broadcast_to(time_decay, current_key.shape)),
+            axis=sequence_axis
+        ),
+        jnp.concatenate((num_state[..., None, :], current_value), axis=sequence_axis),
+        jnp.concatenate((den_state[..., None, :], jnp.ones_like(current_key)), axis=sequence_axis),
+        jnp.concatenate((max_state[..., None, :], current_key), axis=sequence_axis),
+    )
+    _, num_states, den_states, max_states = jax.lax.associative_scan(combine, elements, axis=sequence_axis)
+
+    previous_num, previous_den, previous_max = (
+        num_states[..., :-1, :], den_states[..., :-1, :], max_states[..., :-1, :]
+    )
+    _, e1, e2 = max_shift(previous_max, current_key + time_first)
+    output = (e1 * previous_num + e2 * current_value) / (e1 * previous_den + e2)
 
     if return_state or state is not None:
-        state = [num_state, den_state, max_state]
+        state = [num_states[..., -1, :], den_states[..., -1, :], max_states[..., -1, :]]
 
     return output, state
 
@@ -99,17 +295,23 @@ class FlaxRwkvSelfAttention(nn.Module):
         )
         self.attention_hidden_size = attention_hidden_size
 
-        ratio_0_to_1 = layer_id / (num_hidden_layers - 1)
-        ratio_1_to_almost_0 = 1.0 - (layer_id / num_hidden_layers)
-        zigzag = .5 * (jnp.arange(1, hidden_size + 1) % 3 - 1)
-        time_first = jnp.full(hidden_size, math.log(.3)) + zigzag
-        h = jnp.arange(0, hidden_size)
-        time_decay = -5 + 8 * (h / (hidden_size - 1)) ** (.7 + 1.3 * ratio_0_to_1)
-        x = jnp.arange(hidden_size) / hidden_size
+        def init_values(idx):
+            ratio_0_to_1 = idx / (num_hidden_layers - 1)
+            ratio_1_to_almost_0 = 1.0 - (idx / num_hidden_layers)
+            h = np.arange(0, hidden_size)
+            decay = -5 + 8 * (h / (hidden_size - 1)) ** (.7 + 1.3 * ratio_0_to_1)
+            x = np.arange(hidden_size) / hidden_size
 
-        time_mix_key = jnp.power(x, ratio_1_to_almost_0)
-        time_mix_value = time_mix_key + .3 * ratio_0_to_1
-        time_mix_receptance = jnp.power(x, .5 * ratio_1_to_almost_0)
+            mix_key = np.power(x, ratio_1_to_almost_0)
+            mix_value = mix_key + .3 * ratio_0_to_1
+            mix_receptance = np.power(x, .5 * ratio_1_to_almost_0)
+            return decay, mix_key, mix_value, mix_receptance
+
+        time_decay, time_mix_key, time_mix_value, time_mix_receptance = layer_constants(
+            init_values, layer_id, num_hidden_layers
+        )
+        zigzag = .5 * (np.arange(1, hidden_size + 1) % 3 - 1)
+        time_first = np.full(hidden_size, math.log(.3), dtype=np.float32) + zigzag
 
         # This makes it easier to convert torch model into easydel since we use automated/small translation between
         # jax and torch
@@ -141,22 +343,12 @@ class FlaxRwkvSelfAttention(nn.Module):
             init_fn=init_to_value(time_mix_receptance, self.dtype),
         )
 
-        self.key = nn.Dense(
-            attention_hidden_size,
-            use_bias=False,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            precision=self.precision
-        )
-        self.value = nn.Dense(
-            attention_hidden_size,
-            use_bias=False,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            precision=self.precision
-        )
-        self.receptance = nn.Dense(
+        # key, value and receptance projections stacked on a leading axis (3, hidden_size, attention_hidden_size)
+        # so the three differently mixed inputs go through a single batched matmul
+        self.key_value_receptance = nn.DenseGeneral(
             attention_hidden_size,
+            axis=-1,
+            batch_dims=(0,),
             use_bias=False,
             dtype=self.dtype,
             param_dtype=self.param_dtype,
@@ -176,44 +368,38 @@ class FlaxRwkvSelfAttention(nn.Module):
             state: Tuple[chex.Array, chex.Array, chex.Array, chex.Array],
     ):
         sx, aa, bb, pp = state
-        c_x = jnp.concatenate(
+        mix = jnp.stack(
             (
-                jnp.expand_dims(sx, 0), hidden[:-1, :]
-            ),
-        )
-        key_x = hidden * self.time_mix_key.reshape(-1) + c_x * (1 - self.time_mix_key.reshape(-1))
-        value_x = hidden * self.time_mix_value.reshape(-1) + c_x * (1 - self.time_mix_value.reshape(-1))
-        receptance_x = hidden * self.time_mix_receptance.reshape(-1) + c_x * (1 - self.time_mix_receptance.reshape(-1))
-        receptance_state = nn.sigmoid(self.receptance(receptance_x))
-        key_state = self.key(key_x)
-        value_state = self.value(value_x)
-
-        def step(in_state, kv):
-            (inner_aa, inner_bb, inner_p), (kk, vv) = in_state, kv
-            ww = self.time_first.reshape(-1) + kk
-            p = jnp.maximum(inner_p, ww)
-            e1 = jnp.exp(inner_p - p)
-            e2 = jnp.exp(ww - p)
-            next_c_x = (
-                    (e1 * inner_aa + e2 * vv) / (e1 * inner_bb + e2)
-            ).astype(dtype=receptance_state.dtype)
-
-            ww = -jnp.exp(self.time_decay.reshape(-1)) + inner_p
-            p = jnp.maximum(ww, kk)
-            e1 = jnp.exp(ww - p)
-            e2 = jnp.exp(kk - p)
-            inner_aa = e1 * inner_aa + e2 * vv
-            inner_bb = e1 * inner_bb + e2
-            inner_p = p
-            next_inner_state = (inner_aa, inner_bb, inner_p)
-            return next_inner_state, next_c_x
-
-        (aa, bb, pp), c_x = jax.lax.scan(
-            step,
-            (aa, bb, pp),
-            (key_state, value_state)
-        )
-        out = hidden + self.output(receptance_state * c_x)
+                self.time_mix_key.reshape(-1),
+                self.time_mix_value.reshape(-1),
+                self.time_mix_receptance.reshape(-1)
+            )
+        )[:, None, :]
+        key_state, value_state, receptance_state = self.key_value_receptance(time_mix(hidden, sx, mix))
+        receptance_state = nn.sigmoid(receptance_state.astype(jnp.float32))
+
+        # Decoding a single token is one straight-line state update, prompts are processed with the parallel
+        # prefix scan
+        if hidden.shape[0] == 1:
+            rwkv, (aa, bb, pp) = rwkv_linear_attention_step(
+                self.time_decay.reshape(-1),
+                self.time_first.reshape(-1),
+                key_state,
+                value_state,
+                (aa, bb, pp)
+            )
+        else:
+            rwkv, (aa, bb, pp) = rwkv_linear_attention_parallel(
+                self.time_decay.reshape(-1),
+                self.time_first.reshape(-1),
+                key_state,
+                value_state,
+                state=(aa, bb, pp),
+                return_state=True
+            )
+        # sigmoid(r) and the wkv output are both float32, so the gate product is rounded to the compute dtype only
+        # once, right before the output projection
+        out = self.output((receptance_state * rwkv).astype(self.dtype))
         next_state = (hidden[-1, :], aa, bb, pp)
         return out, next_state
 
@@ -234,11 +420,15 @@ class FlaxRwkvFeedForward(nn.Module):
             config.intermediate_size if config.intermediate_size is not None else 4 * config.hidden_size
         )
 
-        x = jnp.arange(hidden_size) / hidden_size
+        def init_values(idx):
+            x = np.arange(hidden_size) / hidden_size
+
+            ratio_1_to_almost_0 = 1.0 - (idx / num_hidden_layers)
+            mix_key = np.power(x, ratio_1_to_almost_0)
+            mix_receptance = np.power(x, .5 * ratio_1_to_almost_0)
+            return mix_key, mix_receptance
 
-        ratio_1_to_almost_0 = 1.0 - (layer_id / num_hidden_layers)
-        time_mix_key = jnp.power(x, ratio_1_to_almost_0)
-        time_mix_receptance = jnp.power(x, .5 * ratio_1_to_almost_0)
+        time_mix_key, time_mix_receptance = layer_constants(init_values, layer_id, num_hidden_layers)
 
         # This makes it easier to convert torch model into easydel since we use automated/small translation between
         # jax and torch
@@ -282,11 +472,10 @@ class FlaxRwkvFeedForward(nn.Module):
             hidden,
             state
     ):
-        sx = jnp.concatenate(
-            (jnp.expand_dims(state, 0), hidden[:-1, :])
-        )
-        xk = hidden * self.time_mix_key.reshape(-1) + sx * (1 - self.time_mix_key.reshape(-1))
-        xr = hidden * self.time_mix_receptance.reshape(-1) + sx * (1 - self.time_mix_receptance.reshape(-1))
+        # key and receptance project to different widths, so they stay two matmuls, but both mixes come out of a
+        # single time_mix call that reads `hidden` and the shifted states once.
+        mix = jnp.stack((self.time_mix_key.reshape(-1), self.time_mix_receptance.reshape(-1)))[:, None, :]
+        xk, xr = time_mix(hidden, state, mix)
         r = nn.sigmoid(self.receptance(xr))
         k = jnp.square(nn.relu(self.key(xk)))
         return r * self.value(k), hidden[-1, :]
@@ -304,7 +493,8 @@ class SingleStandFlaxRwkvBlock(nn.Module):
         config = self.config
         layer_id = self.layer_id
 
-        if layer_id == 0:
+        # with `scan_layers` the layer id is traced and the collection owns `pre_ln`
+        if not config.scan_layers and layer_id == 0:
             self.pre_ln = nn.LayerNorm(
                 epsilon=config.layer_norm_epsilon,
                 dtype=self.dtype,
@@ -345,10 +535,10 @@ class SingleStandFlaxRwkvBlock(nn.Module):
     ):
 
         if state is None:
-            state = init_state(self.config.hidden_size)
-
-        self_state, ffd_state = state
-        if self.layer_id == 0:
+            self_state, ffd_state = init_state(self.config.hidden_size)
+        else:
+            ffd_state, self_state = state[0], tuple(state[1:])
+        if not self.config.scan_layers and self.layer_id == 0:
             hidden = self.pre_ln(hidden)
 
         attention, self_state = self.attention(
@@ -363,7 +553,7 @@ class SingleStandFlaxRwkvBlock(nn.Module):
         )
         hidden = hidden + feed_forward
 
-        outputs = (hidden, (self_state, ffd_state))
+        outputs = (hidden, [ffd_state, *self_state])
         if output_attentions:
             outputs += (attention,)
         else:
@@ -374,13 +564,55 @@ class SingleStandFlaxRwkvBlock(nn.Module):
 
 FlaxRwkvBlock = nn.vmap(
     SingleStandFlaxRwkvBlock,
-    in_axes=0,
+    in_axes=(0, 0, None),
     out_axes=0,
     split_rngs={"params": False},
     variable_axes={"params": None}
 )
 
 
+class FlaxRwkvScanBlock(nn.Module):
+    """
+    One layer of the `scan_layers` path, written as a `flax.linen.scan` body: the hidden states are the carry and
+    (layer_id, layer_state) are scanned over, so the layer dependent initializers receive the (traced) layer id.
+    """
+    config: RwkvConfig
+    dtype: jnp.dtype = jnp.float32
+    param_dtype: jnp.dtype = jnp.float32
+    precision: Optional[Union[str, jax.lax.Precision]] = None
+    layers_are_rescaled: bool = False
+
+    @nn.compact
+    def __call__(
+            self,
+            hidden_states: chex.Array,
+            inputs: Tuple[chex.Array, Optional[List[chex.Array]]],
+            output_attentions: bool = False,
+            output_hidden_states: bool = False,
+    ):
+        layer_id, layer_state = inputs
+        hidden_states, new_layer_state, attentions = FlaxRwkvBlock(
+            config=self.config,
+            dtype=self.dtype,
+            param_dtype=self.param_dtype,
+            precision=self.precision,
+            layer_id=layer_id,
+            name="block"
+        )(hidden_states, layer_state, output_attentions)
+
+        if self.layers_are_rescaled and self.config.rescale_every > 0:
+            hidden_states = jnp.where(
+                (layer_id + 1) % self.config.rescale_every == 0,
+                hidden_states / 2,
+                hidden_states
+            )
+        return hidden_states, (
+            new_layer_state if layer_state is not None else None,
+            attentions if output_attentions else None,
+            hidden_states if output_hidden_states else None
+        )
+
+
 class FlaxRwkvBlockCollection(nn.Module):
     config: RwkvConfig
     dtype: jnp.dtype = jnp.float32
@@ -388,19 +620,46 @@ class FlaxRwkvBlockCollection(nn.Module):
     precision: Optional[Union[str, jax.lax.Precision]] = None
 
     def setup(self) -> None:
-        self.blocks = [
-            FlaxRwkvBlock(
+        self.layers_are_rescaled = False
+        if self.config.scan_layers:
+            self.pre_ln = nn.LayerNorm(
+                epsilon=self.config.layer_norm_epsilon,
+                dtype=self.dtype,
+                param_dtype=self.param_dtype,
+            )
+            block = FlaxRwkvScanBlock
+            if self.config.gradient_checkpointing != "":
+                block = nn_partitioning.remat(
+                    block,
+                    static_argnums=(2, 3),
+                    policy=get_gradient_checkpoint_policy(self.config.gradient_checkpointing)
+                )
+            self.layers = nn.scan(
+                block,
+                variable_axes={"params": 0},
+                split_rngs={"params": True},
+                in_axes=(0, nn.broadcast, nn.broadcast),
+                out_axes=0,
+                length=self.config.num_hidden_layers
+            )(
                 config=self.config,
                 dtype=self.dtype,
                 param_dtype=self.param_dtype,
                 precision=self.precision,
-                layer_id=idx,
-                name=str(idx)
+                layers_are_rescaled=self.layers_are_rescaled
             )
-            for idx in range(self.config.num_hidden_layers)
-        ]
-
-        self.layers_are_rescaled = False
+        else:
+            self.blocks = [
+                FlaxRwkvBlock(
+                    config=self.config,
+                    dtype=self.dtype,
+                    param_dtype=self.param_dtype,
+                    precision=self.precision,
+                    layer_id=idx,
+                    name=str(idx)
+                )
+                for idx in range(self.config.num_hidden_layers)
+            ]
 
     def __call__(
             self,
@@ -415,13 +674,40 @@ class FlaxRwkvBlockCollection(nn.Module):
     ):
         all_hidden_states = ()
         all_self_attentions = ()
-        use_cache = use_cache if use_cache is not None else (self.config.use_cache if not deterministic else False)
+        use_cache = use_cache if use_cache is not None else (self.config.use_cache if deterministic else False)
+        if self.config.scan_layers:
+            hidden_states = self.pre_ln(hidden_states)
+            hidden_states, (new_state, attentions, hidden_states_per_layer) = self.layers(
+                hidden_states,
+                (jnp.arange(self.config.num_hidden_layers), state),
+                bool(output_attentions),
+                bool(output_hidden_states)
+            )
+            if state is not None:
+                state = [
+                    new_layer_states.astype(layer_states.dtype)
+                    for layer_states, new_layer_states in zip(state, new_state)
+                ]
+            if output_hidden_states:
+                all_hidden_states = tuple(hidden_states_per_layer[idx] for idx in range(hidden_states_per_layer.shape[0]))
+            if output_attentions:
+                all_self_attentions = tuple(attentions[idx] for idx in range(attentions.shape[0]))
+            return hidden_states, state, all_hidden_states, all_self_attentions
+
         for idx, block in enumerate(self.blocks):
+            layer_state = None if state is None else [layer_states[idx] for layer_states in state]
 
-            hidden_states, state, attentions = block(
-                hidden_states, state=state, output_attentions=output_attentions
+            # arguments are passed positionally since `nn.vmap` only maps positional arguments
+            hidden_states, layer_state, attentions = block(
+                hidden_states, layer_state, output_attentions
             )
 
+            if state is not None:
+                state = [
+                    layer_states.at[idx].set(new_state.astype(layer_states.dtype))
+                    for layer_states, new_state in zip(state, layer_state)
+                ]
+
             if (
                     self.layers_are_rescaled
                     and self.config.rescale_every > 0
@@ -434,7 +720,7 @@ class FlaxRwkvBlockCollection(nn.Module):
 
             if output_attentions:
                 all_self_attentions = all_self_attentions + (attentions,)
-        return hidden_states, all_hidden_states, all_self_attentions
+        return hidden_states, state, all_hidden_states, all_self_attentions
 
 
 class FlaxRwkvModule(nn.Module):
@@ -479,7 +765,7 @@ class FlaxRwkvModule(nn.Module):
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
-        use_cache = use_cache if use_cache is not None else (self.config.use_cache if not deterministic else False)
+        use_cache = use_cache if use_cache is not None else (self.config.use_cache if deterministic else False)
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
         if input_ids is not None and inputs_embeds is not None:
@@ -491,10 +777,11 @@ class FlaxRwkvModule(nn.Module):
             inputs_embeds = self.embeddings(input_ids)
 
         if use_cache and state is None:
-            shape = (inputs_embeds.shape[0], self.config.hidden_size, self.config.num_hidden_layers)
+            # Layer is the leading axis so every block reads and writes a contiguous (batch, hidden) slice
+            shape = (self.config.num_hidden_layers, inputs_embeds.shape[0], self.config.hidden_size)
             state = [
                 jnp.zeros(
-                    *shape, dtype=inputs_embeds.dtype if i <= 1 else jnp.float32,
+                    shape, dtype=inputs_embeds.dtype if i <= 1 else jnp.float32,
                 )
                 for i in range(5)
             ]
@@ -502,7 +789,7 @@ class FlaxRwkvModule(nn.Module):
 
         hidden_states = inputs_embeds
 
-        hidden_states, all_hidden_states, all_self_attentions = self.blocks(
+        hidden_states, state, all_hidden_states, all_self_attentions = self.blocks(
             hidden_states,
             attention_mask,
             state,
@@ -577,7 +864,11 @@ class FlaxRwkvForCausalLMModule(nn.Module):
         )
         hidden_states = rwkv_outputs[0]
 
-        logits = self.head(hidden_states)
+        if self.config.tie_word_embeddings:
+            shared_kernel = self.rwkv.variables["params"]["embeddings"]["embedding"].T
+            logits = self.head.apply({"params": {"kernel": shared_kernel}}, hidden_states)
+        else:
+            logits = self.head(hidden_states)
 
         if not return_dict:
             return (logits,) + rwkv_outputs[1:]
@@ -619,6 +910,8 @@ class FlaxRwkvPretrainedModel(EasyDelFlaxPretrainedModel):
             dtype=dtype,
             _do_init=_do_init
         )
+        self._decode_apply = None
+        self._donated_decode_apply = None
 
     def init_weights(
             self,
@@ -660,6 +953,7 @@ class FlaxRwkvPretrainedModel(EasyDelFlaxPretrainedModel):
             train: bool = False,
             extra_embedding: Optional[Union[jnp.ndarray, None]] = None,
             add_params_field: bool = False,
+            donate_state: bool = False,
     ):
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -684,14 +978,39 @@ class FlaxRwkvPretrainedModel(EasyDelFlaxPretrainedModel):
 
         mutable = False
 
-        return self.module.apply(
+        apply_fn = self.module.apply
+        if state is not None and sequence_length == 1:
+            # single token decode runs through a cached jitted apply, so every step reuses the compiled step instead
+            # of dispatching the model op by op. With `donate_state` the donating variant is used: the new state
+            # reuses the buffers of the incoming one and decode memory stays at one copy of the state, but the
+            # passed state can not be used again after this call (keep the default when the same state is reused,
+            # e.g. for beam search or retries).
+            if donate_state:
+                if self._donated_decode_apply is None:
+                    self._donated_decode_apply = jax.jit(
+                        self.module.apply,
+                        static_argnums=(5, 6, 7, 8, 9),
+                        static_argnames=("mutable",),
+                        donate_argnums=(4,)
+                    )
+                apply_fn = self._donated_decode_apply
+            else:
+                if self._decode_apply is None:
+                    self._decode_apply = jax.jit(
+                        self.module.apply,
+                        static_argnums=(5, 6, 7, 8, 9),
+                        static_argnames=("mutable",)
+                    )
+                apply_fn = self._decode_apply
+
+        return apply_fn(
             inputs,
             input_ids,
             attention_mask,
             inputs_embeds,
             state,
+            not train,
             use_cache,
-            train,
             output_attentions,
             output_hidden_states,
             return_dict,
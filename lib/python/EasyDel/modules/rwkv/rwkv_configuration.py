@@ -28,10 +28,12 @@ class RwkvConfig(EasyDelPretrainedConfig):
             bits: Optional[int] = None,
             gradient_checkpointing: str = "nothing_saveable",
             use_pjit_attention_force: bool = False,
+            scan_layers: bool = False,
             **kwargs
     ) -> None:
 
         self.bits = bits
+        self.scan_layers = scan_layers
         self.gradient_checkpointing = gradient_checkpointing
         self.use_pjit_attention_force = use_pjit_attention_force
         self.vocab_size = vocab_size
@@ -60,9 +62,20 @@ class RwkvConfig(EasyDelPretrainedConfig):
             bits: Optional[int] = None,
             gradient_checkpointing: str = "nothing_saveable",
             use_pjit_attention_force: bool = False,
+            scan_layers: bool = False,
             **kwargs
     ):
+        """
+        The add_jax_args function adds the jax/easydel specific arguments to the config.
+
+        :param bits: Optional[int]: Determine the number of bits used in the quantization
+        :param gradient_checkpointing: str: Control the amount of memory used by jax
+        :param use_pjit_attention_force: bool: Determine if the attention force is used
+        :param scan_layers: bool: Run the blocks with `flax.linen.scan` over stacked parameters (layer is the
+            leading axis of every block parameter, so checkpoints are not interchangeable with the per-layer layout)
+        """
         self.bits = bits
+        self.scan_layers = scan_layers
         self.gradient_checkpointing = gradient_checkpointing
         self.use_pjit_attention_force = use_pjit_attention_force
         for k, v in kwargs.items():
@@ -70,8 +83,17 @@ class RwkvConfig(EasyDelPretrainedConfig):
                 setattr(self, k, v)
 
     def get_partition_rules(self, fully_sharded_data_parallel: bool = True):
-        return (
+        # the fused attention projection is stacked as (3, hidden_size, attention_hidden_size) and is sharded on
+        # hidden_size, every other parameter on its first axis. scanned block parameters carry the layer as an
+        # extra leading axis, so their rules are the same specs with a leading None
+        scan_rules = (
+            ("blocks/layers/.*key_value_receptance/kernel", PartitionSpec(None, None, ("sp", "fsdp"), None)),
+            ("blocks/layers/.*", PartitionSpec(None, ("sp", "fsdp"))),
+        ) if self.scan_layers else ()
+        return scan_rules + (
+            ("attention/key_value_receptance/kernel", PartitionSpec(None, ("sp", "fsdp"), None)),
             (".*", PartitionSpec(("sp", "fsdp"))),
-        ) if fully_sharded_data_parallel else (
+        ) if fully_sharded_data_parallel else scan_rules + (
+            ("attention/key_value_receptance/kernel", PartitionSpec(None, ("sp", "fsdp"), None)),
             (".*", PartitionSpec(("sp", "fsdp"))),
         )
@@ -122,6 +122,44 @@ def match_keywords(string, ts, ns):
 #             pbar.update(1)
 #         return flax.traverse_util.unflatten_dict(flax_dict)
 
+def fuse_rwkv_attention_projections(flax_dict: dict, shard_fns: Optional[Mapping[tuple, Callable]] = None):
+    """
+    The fuse_rwkv_attention_projections function stacks the `key`, `value` and `receptance` kernels of every rwkv
+    attention block into the single `key_value_receptance` kernel of shape (3, hidden_size, attention_hidden_size)
+    that easydel uses.
+
+    :param flax_dict: dict: Flatten dictionary (tuple keys) of the converted weights
+    :param shard_fns: Optional[Mapping[tuple, Callable]]: Sharding Function to be used to shard the fused kernel
+    :return: The flatten dictionary with the fused kernels
+    """
+    for key_tuple in [k for k in flax_dict.keys() if k[-3:] == ("attention", "key", "kernel")]:
+        prefix = key_tuple[:-2]
+        fused_key = prefix + ("key_value_receptance", "kernel")
+        tensor = jnp.stack(
+            [flax_dict.pop(prefix + (name, "kernel")) for name in ("key", "value", "receptance")]
+        )
+        if shard_fns and fused_key in shard_fns:
+            tensor = shard_fns[fused_key](tensor)
+        flax_dict[fused_key] = tensor
+    return flax_dict
+
+
+def split_rwkv_attention_projections(flax_dict: dict):
+    """
+    The split_rwkv_attention_projections function is the inverse of `fuse_rwkv_attention_projections`, it splits
+    every fused `key_value_receptance` kernel back into the `key`, `value` and `receptance` kernels of shape
+    (hidden_size, attention_hidden_size).
+
+    :param flax_dict: dict: Flatten dictionary (tuple keys) of the easydel weights
+    :return: The flatten dictionary with the split kernels
+    """
+    for key_tuple in [k for k in flax_dict.keys() if k[-3:] == ("attention", "key_value_receptance", "kernel")]:
+        prefix = key_tuple[:-2]
+        for name, kernel in zip(("key", "value", "receptance"), flax_dict.pop(key_tuple)):
+            flax_dict[prefix + (name, "kernel")] = kernel
+    return flax_dict
+
+
 def huggingface_to_easydel(
         state_dict,
         *,
@@ -146,7 +184,8 @@ def huggingface_to_easydel(
     :param shard_fns: Optional[Mapping[tuple, Callable]]: Sharding Function to be used to shard model
     :param dtype: jax.numpy.dtype: Specify the data type of the tensors
     :param rnn_based_or_rwkv: bool: rnn_based_or_rwkv is a conditioner which decide whenever it finds a value in tree
-    that start with time_mix_ it will automatically reshape that for easydel use case
+    that start with time_mix_ it will automatically reshape that for easydel use case (and fuse the rwkv attention
+    key, value and receptance kernels)
     :return: A dictionary of the weights and biases in a format that can be used by flax (it's an UnFlattenDict)
 
     """
@@ -188,6 +227,9 @@ def huggingface_to_easydel(
             pbar.update(1)
         pbar.close()
 
+        if rnn_based_or_rwkv:
+            flax_dict = fuse_rwkv_attention_projections(flax_dict, shard_fns)
+
         gc.collect()
         return traverse_util.unflatten_dict(flax_dict)
 
@@ -268,12 +310,13 @@ def easystate_to_torch(
         return True
 
     model_parameters = flatten_dict(
-        state.params["params"],
-        sep="."
+        state.params["params"]
     ) if select_params_field else flatten_dict(
-        state.params,
-        sep="."
+        state.params
     )
+    if rnn_based_or_rwkv:
+        model_parameters = split_rwkv_attention_projections(model_parameters)
+    model_parameters = {".".join(key): tensor for key, tensor in model_parameters.items()}
     torch_state_dict = {}
     pbar = tqdm(
         model_parameters.items(),
@@ -0,0 +1,309 @@
+import unittest
+from unittest import TestCase
+
+try:
+    from lib.python.EasyDel.modules.rwkv import modelling_rwkv_flax
+    from lib.python.EasyDel.modules.rwkv.rwkv_configuration import RwkvConfig
+    from lib.python.EasyDel.transform.easydel_transform import (
+        fuse_rwkv_attention_projections,
+        split_rwkv_attention_projections
+    )
+except ModuleNotFoundError:
+    import sys
+    from pathlib import Path
+
+    cp = Path.cwd().__str__()
+    sys.path.append(cp)
+    from lib.python.EasyDel.modules.rwkv import modelling_rwkv_flax
+    from lib.python.EasyDel.modules.rwkv.rwkv_configuration import RwkvConfig
+    from lib.python.EasyDel.transform.easydel_transform import (
+        fuse_rwkv_attention_projections,
+        split_rwkv_attention_projections
+    )
+
+import flax.traverse_util
+import jax
+import numpy as np
+from fjformer import match_partition_rules
+from jax import numpy as jnp
+from jax.sharding import PartitionSpec
+
+
+class EasyRwkvTest(TestCase):
+
+    def setUp(self) -> None:
+        self.batch_size: int = 2
+        self.sequence_length: int = 8
+        self.vocab_size: int = 128
+        self.hidden_size: int = 32
+        self.intermediate_size: int = 64
+        self.num_hidden_layers: int = 3
+        self.rng = np.random.RandomState(0)
+
+    def create_model(self, tie_word_embeddings: bool = False, **kwargs):
+        config = RwkvConfig(
+            vocab_size=self.vocab_size,
+            hidden_size=self.hidden_size,
+            intermediate_size=self.intermediate_size,
+            num_hidden_layers=self.num_hidden_layers,
+            tie_word_embeddings=tie_word_embeddings,
+        )
+        config.add_jax_args(**kwargs)
+        model = modelling_rwkv_flax.FlaxRwkvForCausalLM(
+            config,
+            input_shape=(self.batch_size, self.sequence_length),
+            _do_init=True
+        )
+        # move the parameters away from their initial values so every path of the block is exercised
+        model.params = jax.tree_util.tree_map(
+            lambda p: p + 0.1 * self.rng.randn(*p.shape).astype(p.dtype), model.params
+        )
+        return model
+
+    def create_input_ids(self):
+        return jnp.asarray(
+            self.rng.randint(0, self.vocab_size, (self.batch_size, self.sequence_length)),
+            dtype="i4"
+        )
+
+    def assert_close(self, a, b, atol=1e-5):
+        self.assertTrue(
+            np.allclose(np.asarray(a), np.asarray(b), atol=atol),
+            f"max error {np.abs(np.asarray(a) - np.asarray(b)).max()}"
+        )
+
+    @staticmethod
+    def linear_attention_reference(time_decay, time_first, key, value, state=None):
+        """
+        Token by token float64 NumPy version of the WKV recurrence, as in the torch RWKV implementation.
+        """
+        key, value = np.asarray(key, np.float64), np.asarray(value, np.float64)
+        if state is None:
+            num_state = np.zeros_like(key[:, 0])
+            den_state = np.zeros_like(key[:, 0])
+            max_state = np.full_like(key[:, 0], -1e38)
+        else:
+            num_state, den_state, max_state = (np.asarray(s, np.float64) for s in state)
+        time_decay = -np.exp(np.asarray(time_decay, np.float64))
+        time_first = np.asarray(time_first, np.float64)
+        output = np.zeros_like(key)
+        for t in range(key.shape[1]):
+            current_key, current_value = key[:, t], value[:, t]
+            max_for_output = np.maximum(max_state, current_key + time_first)
+            e1 = np.exp(max_state - max_for_output)
+            e2 = np.exp(current_key + time_first - max_for_output)
+            output[:, t] = (e1 * num_state + e2 * current_value) / (e1 * den_state + e2)
+
+            max_for_state = np.maximum(max_state + time_decay, current_key)
+            e1 = np.exp(max_state + time_decay - max_for_state)
+            e2 = np.exp(current_key - max_for_state)
+            num_state = e1 * num_state + e2 * current_value
+            den_state = e1 * den_state + e2
+            max_state = max_for_state
+        return output, [num_state, den_state, max_state]
+
+    def test_linear_attention_kernels(self):
+        time_decay = self.rng.randn(self.hidden_size).astype(np.float32)
+        time_first = self.rng.randn(self.hidden_size).astype(np.float32)
+        shape = (self.batch_size, 37, self.hidden_size)
+        key = (3 * self.rng.randn(*shape)).astype(np.float32)
+        value = self.rng.randn(*shape).astype(np.float32)
+        _, incoming_state = self.linear_attention_reference(
+            time_decay,
+            time_first,
+            self.rng.randn(*shape).astype(np.float32),
+            self.rng.randn(*shape).astype(np.float32)
+        )
+        incoming_state = [jnp.asarray(s, jnp.float32) for s in incoming_state]
+
+        for state in (None, incoming_state):
+            expected, expected_state = self.linear_attention_reference(time_decay, time_first, key, value, state)
+            for kernel in (
+                    modelling_rwkv_flax.rwkv_linear_attention,
+                    modelling_rwkv_flax.rwkv_linear_attention_parallel
+            ):
+                output, output_state = kernel(time_decay, time_first, key, value, state=state, return_state=True)
+                self.assert_close(output, expected)
+                for a, b in zip(output_state, expected_state):
+                    self.assert_close(a, b, atol=1e-4)
+
+            outputs = []
+            step_state = state if state is not None else [
+                jnp.zeros(shape[::2]), jnp.zeros(shape[::2]), jnp.full(shape[::2], -1e38)
+            ]
+            for t in range(key.shape[1]):
+                output, step_state = modelling_rwkv_flax.rwkv_linear_attention_step(
+                    time_decay, time_first, key[:, t:t + 1], value[:, t:t + 1], step_state
+                )
+                outputs.append(output)
+            self.assert_close(jnp.concatenate(outputs, axis=1), expected)
+            for a, b in zip(step_state, expected_state):
+                self.assert_close(a, b, atol=1e-4)
+
+    def stack_layer_params(self, params):
+        """
+        Converts per-layer parameters ("blocks/0", "blocks/1", ...) into the scan_layers layout.
+        """
+        params = flax.traverse_util.unflatten_dict(flax.traverse_util.flatten_dict(params))
+        blocks = params["rwkv"]["blocks"]
+        pre_ln = blocks["0"].pop("pre_ln")
+        layers = [blocks.pop(str(idx)) for idx in range(self.num_hidden_layers)]
+        blocks["pre_ln"] = pre_ln
+        blocks["layers"] = {"block": jax.tree_util.tree_map(lambda *xs: jnp.stack(xs), *layers)}
+        return params
+
+    def test_scan_layers(self):
+        input_ids = self.create_input_ids()
+        for gradient_checkpointing in ("", "nothing_saveable"):
+            model = self.create_model(gradient_checkpointing=gradient_checkpointing)
+            scan_model = self.create_model(gradient_checkpointing=gradient_checkpointing, scan_layers=True)
+            params = model.params
+            scan_params = self.stack_layer_params(params)
+            self.assertEqual(
+                jax.tree_util.tree_structure(scan_params), jax.tree_util.tree_structure(scan_model.params)
+            )
+
+            output = model(input_ids, params={"params": params}, return_dict=True, output_hidden_states=True)
+            scan_output = scan_model(
+                input_ids, params={"params": scan_params}, return_dict=True, output_hidden_states=True
+            )
+            self.assert_close(output.logits, scan_output.logits)
+            self.assertEqual(len(output.hidden_states), len(scan_output.hidden_states))
+            for a, b in zip(output.hidden_states, scan_output.hidden_states):
+                self.assert_close(a, b)
+            for a, b in zip(output.state, scan_output.state):
+                self.assert_close(a, b)
+
+            token = input_ids[:, :1]
+            self.assert_close(
+                model(token, state=output.state, params={"params": params}, return_dict=True).logits,
+                scan_model(token, state=scan_output.state, params={"params": scan_params}, return_dict=True).logits
+            )
+
+            def loss(p, m):
+                return m.module.apply(
+                    {"params": p}, input_ids, deterministic=False, use_cache=False
+                ).logits.mean()
+
+            grads = self.stack_layer_params(jax.grad(loss)(params, model))
+            scan_grads = jax.grad(loss)(scan_params, scan_model)
+            for a, b in zip(jax.tree_util.tree_leaves(grads), jax.tree_util.tree_leaves(scan_grads)):
+                self.assert_close(a, b, atol=1e-6)
+
+    def test_scan_layers_partition_rules(self):
+        model = self.create_model()
+        scan_model = self.create_model(scan_layers=True)
+        for fully_sharded_data_parallel in (True, False):
+            specs = flax.traverse_util.flatten_dict(match_partition_rules(
+                model.config.get_partition_rules(fully_sharded_data_parallel), model.params
+            ), sep="/")
+            scan_specs = flax.traverse_util.flatten_dict(match_partition_rules(
+                scan_model.config.get_partition_rules(fully_sharded_data_parallel), scan_model.params
+            ), sep="/")
+            for name, scan_spec in scan_specs.items():
+                if "/layers/block/" in name:
+                    for idx in range(self.num_hidden_layers):
+                        self.assertEqual(
+                            scan_spec,
+                            PartitionSpec(None, *specs[name.replace("/layers/block/", f"/{idx}/")]),
+                            name
+                        )
+                else:
+                    self.assertEqual(scan_spec, specs[name.replace("blocks/pre_ln", "blocks/0/pre_ln")], name)
+
+    def test_fuse_split_attention_projections(self):
+        attention_hidden_size = self.hidden_size + 8
+        flax_dict = {}
+        for idx in range(self.num_hidden_layers):
+            prefix = ("rwkv", "blocks", str(idx))
+            for name in ("key", "value", "receptance"):
+                flax_dict[prefix + ("attention", name, "kernel")] = self.rng.randn(
+                    self.hidden_size, attention_hidden_size
+                ).astype(np.float32)
+            flax_dict[prefix + ("feed_forward", "key", "kernel")] = self.rng.randn(
+                self.hidden_size, self.intermediate_size
+            ).astype(np.float32)
+        original = dict(flax_dict)
+
+        fused = fuse_rwkv_attention_projections(dict(flax_dict))
+        for idx in range(self.num_hidden_layers):
+            prefix = ("rwkv", "blocks", str(idx))
+            kernel = fused[prefix + ("attention", "key_value_receptance", "kernel")]
+            self.assertEqual(kernel.shape, (3, self.hidden_size, attention_hidden_size))
+            for position, name in enumerate(("key", "value", "receptance")):
+                self.assertNotIn(prefix + ("attention", name, "kernel"), fused)
+                self.assert_close(kernel[position], original[prefix + ("attention", name, "kernel")], atol=0)
+            feed_forward_key = prefix + ("feed_forward", "key", "kernel")
+            self.assert_close(fused[feed_forward_key], original[feed_forward_key], atol=0)
+
+        split = split_rwkv_attention_projections(fused)
+        self.assertEqual(set(split.keys()), set(original.keys()))
+        for key, tensor in original.items():
+            self.assertEqual(split[key].shape, tensor.shape)
+            self.assert_close(split[key], tensor, atol=0)
+
+    def test_tie_word_embeddings(self):
+        model = self.create_model(tie_word_embeddings=True)
+        self.assertNotIn("head", model.params)
+        input_ids = self.create_input_ids()
+        embedding = model.params["rwkv"]["embeddings"]["embedding"]
+        base_model = modelling_rwkv_flax.FlaxRwkvModel(model.config, _do_init=False)
+
+        output = model(input_ids, use_cache=True, add_params_field=True, return_dict=True)
+        hidden_states = base_model(
+            input_ids, params=model.params["rwkv"], add_params_field=True, return_dict=True
+        ).last_hidden_state
+        self.assert_close(output.logits, hidden_states @ embedding.T)
+
+        token = input_ids[:, -1:]
+        logits = model(token, state=output.state, use_cache=True, add_params_field=True, return_dict=True).logits
+        hidden_states = base_model(
+            token, state=output.state, params=model.params["rwkv"], add_params_field=True, return_dict=True
+        ).last_hidden_state
+        self.assert_close(logits, hidden_states @ embedding.T)
+
+    def test_decode_state_reuse(self):
+        model = self.create_model()
+        input_ids = self.create_input_ids()
+        state = model(input_ids, use_cache=True, add_params_field=True, return_dict=True).state
+        token = input_ids[:, -1:]
+
+        first = model(token, state=state, use_cache=True, add_params_field=True, return_dict=True).logits
+        second = model(token, state=state, use_cache=True, add_params_field=True, return_dict=True).logits
+        self.assert_close(first, second, atol=0)
+        self.assertFalse(any(s.is_deleted() for s in state))
+
+    def test_decode_uses_cached_jit(self):
+        model = self.create_model()
+        input_ids = self.create_input_ids()
+        state = model(input_ids, use_cache=True, add_params_field=True, return_dict=True).state
+        self.assertIsNone(model._decode_apply)
+
+        for idx in range(3):
+            output = model(
+                input_ids[:, idx:idx + 1], state=state, use_cache=True, add_params_field=True, return_dict=True
+            )
+            self.assertFalse(any(s.is_deleted() for s in state))
+            state = output.state
+        self.assertIsNotNone(model._decode_apply)
+        self.assertEqual(model._decode_apply._cache_size(), 1)
+        self.assertIsNone(model._donated_decode_apply)
+
+    def test_decode_donate_state(self):
+        model = self.create_model()
+        input_ids = self.create_input_ids()
+        state = model(input_ids, use_cache=True, add_params_field=True, return_dict=True).state
+        token = input_ids[:, -1:]
+
+        expected = model(token, state=state, use_cache=True, add_params_field=True, return_dict=True)
+        donated = model(
+            token, state=state, use_cache=True, add_params_field=True, return_dict=True, donate_state=True
+        )
+        self.assert_close(expected.logits, donated.logits)
+        for expected_state, donated_state in zip(expected.state, donated.state):
+            self.assert_close(expected_state, donated_state)
+        self.assertTrue(all(s.is_deleted() for s in state))
+
+
+if __name__ == "__main__":
+    unittest.main()